@@ -9,11 +9,17 @@
 # avoid importing wildcards, remove unused imports
 from battery import Battery, Cell
 from utils import open_serial_port, logger
-from time import sleep
+from time import sleep, time
 from struct import unpack
 from re import findall
+from random import uniform
 import sys
 
+try:
+    from bms.daren_485_shm import StateWriter, state_path
+except ImportError:
+    StateWriter = None
+
 
 class Daren485(Battery):
     def __init__(self, port, baud, address):
@@ -24,9 +30,53 @@ class Daren485(Battery):
         # to address reflecting the position of the DIP-switches on the unit(s), starting at '01'.
         self.address = address
         self.serial_number = ""
+        self.state_writer = None
+        self.response_rtn = None
+
+        # Health of this pack, see update_health()
+        self.health = self.HEALTHY
+        self.failures = 0
+        self.next_probe = 0
+        self.last_update = {}
+        self.realtime_data_time = 0
+
+        self.configured_addresses.setdefault(port, set()).add(address)
 
     BATTERYTYPE = "Daren485"
 
+    # Publish the decoded state of each pack to /dev/shm, so other local tools
+    # can read it without accessing the RS485 bus. See daren_485_shm.py.
+    SHM_EXPORT = True
+
+    # Read service 42 of all packs with a single request to the master pack
+    # (DIP 5/6 set to master), instead of one request per address.
+    # Falls back to per-address polling when the master doesn't support it.
+    AGGREGATED_POLLING = False
+    MASTER_ADDRESS = b"\x01"
+    AGGREGATED_MAX_AGE = 5  # seconds, request again when the data is older
+    AGGREGATED_MAX_FAILURES = 3
+    AGGREGATED_RETRY_INTERVAL = 60  # seconds, probe again after missing replies
+    AGGREGATED_MAX_WAIT = 2  # seconds, max. wait for the full response
+
+    # State of the aggregated polling, shared by all instances per serial port
+    aggregated_state = {}
+    # Addresses of all instances per serial port
+    configured_addresses = {}
+
+    # Per-pack failure isolation: a pack that doesn't answer is taken off the bus
+    # with exponential backoff, so it can't delay the other packs on the same bus.
+    HEALTHY = "healthy"
+    DEGRADED = "degraded"
+    OFFLINE = "offline"
+    OFFLINE_AFTER_FAILURES = 3  # consecutive cycles without any reply
+    BACKOFF_MIN = 2  # seconds
+    BACKOFF_MAX = 60  # seconds
+    # Seconds to keep reporting cached realtime data after the last successful read.
+    # Meanwhile, the cached protection values, FET states and charge limits are
+    # reported as live, and dbus-serialbattery doesn't see the outage. So keep it
+    # to a few poll cycles.
+    STALE_DATA_TIMEOUT = 5
+
     def test_connection(self):
         """
         call a function that will connect to the battery, send a command and retrieve the result.
@@ -71,25 +121,41 @@ class Daren485(Battery):
         Return True if success, False for failure
         """
         result = False
+        if not self.probe_due():
+            logger.debug(
+                "get_settings: address {} is {}, skipped".format(
+                    self.address.hex(), self.health
+                )
+            )
+            return result
+
+        results = {}
         try:
             with open_serial_port(self.port, self.baud_rate) as ser:
                 if ser:
                     if ser.is_open:
-                        result = self.get_serial(ser)
+                        results["serial"] = self.get_serial(ser)
 
-                        result = result and self.get_cells_params(ser)
+                        if results["serial"]:
+                            results["cells_params"] = self.get_cells_params(ser)
 
-                        if result:
+                        if results.get("cells_params"):
                             # init the cell array once
                             if len(self.cells) == 0:
                                 for _ in range(self.cell_count):
                                     self.cells.append(Cell(False))
 
-                        result = result and self.get_realtime_data(ser)
+                            results["realtime_data"] = self.get_realtime_data(ser)
 
-                        result = result and self.get_manufacturer_info(ser)
+                        # serial, cell count and realtime data are required,
+                        # manufacturer info and capacity params are optional.
+                        result = results.get("realtime_data", False)
 
-                        result = result and self.get_cap_params(ser)
+                        if result:
+                            results["manufacturer_info"] = self.get_manufacturer_info(
+                                ser
+                            )
+                            results["cap_params"] = self.get_cap_params(ser)
                     else:
                         logger.error("Error opening serialport!")
                 else:
@@ -105,6 +171,8 @@ class Daren485(Battery):
             )
             logger.error(">>> ERROR: No reply - returning")
 
+        self.update_health(results)
+
         return result
 
     def refresh_data(self):
@@ -113,19 +181,27 @@ class Daren485(Battery):
         This will be called for every iteration (1 second)
         Return True if success, False for failure
         """
-        result = False
+        if not self.probe_due():
+            # Pack is offline, don't spend bus time on it until the next probe
+            return self.data_valid()
+
+        results = {}
         try:
             with open_serial_port(self.port, self.baud_rate) as ser:
                 if ser:
                     if ser.is_open:
-                        result = self.get_realtime_data(ser)
-
-                        # get cells_params to get max (dis)charge params,
-                        # but use the FET status registers from realtime data
-                        # to set them to 0 when needed.
-                        result = result and self.get_cells_params(ser)
-
-                        result = result and self.get_cap_params(ser)
+                        results["realtime_data"] = self.get_realtime_data(ser)
+
+                        # Services are isolated: values of services that fail keep
+                        # their last valid value. But if the pack doesn't answer
+                        # at all, don't wait for the other services as well.
+                        if results["realtime_data"] or self.health == self.HEALTHY:
+                            # get cells_params to get max (dis)charge params,
+                            # but use the FET status registers from realtime data
+                            # to set them to 0 when needed.
+                            results["cells_params"] = self.get_cells_params(ser)
+
+                            results["cap_params"] = self.get_cap_params(ser)
                     else:
                         logger.error("Error opening serialport!")
                 else:
@@ -134,14 +210,105 @@ class Daren485(Battery):
         except OSError:
             logger.warning("Couldn't open serial port")
 
+        self.update_health(results)
+        result = self.data_valid()
+
         if not result:  # TROUBLESHOOTING for no reply errors
             logger.info(
                 f"refresh_data: result: {result}."
                 + " If you don't see this warning very often, you can ignore it."
             )
+        elif results.get("realtime_data"):
+            self.publish_state()
 
         return result
 
+    def probe_due(self):
+        """
+        Return True if the pack may be accessed on the bus,
+        False while it is offline and waiting for its next probe.
+        """
+        return self.health != self.OFFLINE or time() >= self.next_probe
+
+    def data_valid(self):
+        """
+        Return True if the cached realtime data is recent enough to be reported.
+        """
+        last_update = self.last_update.get("realtime_data", 0)
+        return time() - last_update <= self.STALE_DATA_TIMEOUT
+
+    def update_health(self, results):
+        """
+        Update the health of the pack with the results of the services of one cycle.
+        healthy: all services succeeded.
+        degraded: some services failed, or the pack didn't reply for less than
+        OFFLINE_AFTER_FAILURES cycles. Cached values of failed services are kept.
+        offline: no reply for OFFLINE_AFTER_FAILURES cycles. The pack is only probed
+        again after an exponential, jittered backoff.
+        """
+        if not results:
+            # serial port error, not related to this pack
+            return
+
+        now = time()
+        for service, success in results.items():
+            if success:
+                self.last_update[service] = now
+        if results.get("realtime_data"):
+            # the realtime data may have been read earlier by an aggregated request
+            self.last_update["realtime_data"] = self.realtime_data_time
+
+        if all(results.values()):
+            if self.health != self.HEALTHY:
+                logger.info("Address {} is healthy again".format(self.address.hex()))
+            self.health = self.HEALTHY
+            self.failures = 0
+            self.next_probe = 0
+        elif any(results.values()):
+            self.health = self.DEGRADED
+            self.failures = 0
+            self.next_probe = 0
+        else:
+            self.failures += 1
+            if self.failures >= self.OFFLINE_AFTER_FAILURES:
+                exponent = min(self.failures - self.OFFLINE_AFTER_FAILURES, 16)
+                backoff = min(self.BACKOFF_MAX, self.BACKOFF_MIN * 2**exponent)
+                # jitter, so offline packs don't get probed in lockstep
+                backoff = backoff * uniform(0.5, 1.0)
+                self.next_probe = now + backoff
+                if self.health != self.OFFLINE:
+                    logger.warning(
+                        "Address {} is offline after {} failed cycles".format(
+                            self.address.hex(), self.failures
+                        )
+                    )
+                logger.info(
+                    "Address {}: next probe in {:.1f}s".format(
+                        self.address.hex(), backoff
+                    )
+                )
+                self.health = self.OFFLINE
+            else:
+                self.health = self.DEGRADED
+
+    def publish_state(self):
+        """
+        Publish the latest decoded state to shared memory, if enabled.
+        Failures are logged and disable the export, but never fail the refresh.
+        """
+        if not self.SHM_EXPORT or StateWriter is None:
+            return
+
+        try:
+            if self.state_writer is None:
+                path = state_path(self.port, self.address)
+                self.state_writer = StateWriter(path)
+                logger.info("Publishing state to {}".format(path))
+            self.state_writer.publish(self, self.realtime_data_time)
+        except Exception as e:
+            logger.error("Exception during publish_state: {}".format(e))
+            self.SHM_EXPORT = False
+
     def get_serial(self, ser):
         """
         Read serial from device by calling the get_mfg_params command,
@@ -221,198 +388,402 @@ class Daren485(Battery):
         using service 42 and extracting the majority of the available data,
         such as SOC, voltages, current, temperatures and alarms/warnings/statusinformation.
         """
-        result = False
+        payload = None
 
-        req = self.create_command_get_realtime_data()
+        if self.AGGREGATED_POLLING:
+            aggregated = self.get_aggregated_realtime_data(ser)
+            if aggregated is not None:
+                payload, read_time = aggregated
 
-        ser.flushOutput()
-        ser.flushInput()
-        ser.write(req.encode())
-        logger.debug("get_realtime_data request sent: {}".format(req))
+        if payload is None:
+            req = self.create_command_get_realtime_data()
 
-        sleep(0.5)  # Allow the BMS some time to send a full response
+            ser.flushOutput()
+            ser.flushInput()
+            ser.write(req.encode())
+            logger.debug("get_realtime_data request sent: {}".format(req))
 
-        response = self.read_response(ser)
+            sleep(0.5)  # Allow the BMS some time to send a full response
 
-        if response:
-            payload = response[13 : len(response) - 5]
-            if len(payload) >= 118:
-                self.soc = int(payload[2:6], base=16) / 100
-                self.voltage = int(payload[6:10], base=16) / 100
-                self.current = unpack(">h", bytes.fromhex(payload[106:110]))[0] / 100
-                temp_mos = unpack(">h", bytes.fromhex(payload[84:88]))[0] / 10
-                self.to_temp(0, temp_mos)
-                temp1 = unpack(">h", bytes.fromhex(payload[90:94]))[0] / 10
-                self.to_temp(1, temp1)
-                temp2 = unpack(">h", bytes.fromhex(payload[94:98]))[0] / 10
-                self.to_temp(2, temp2)
-                temp3 = unpack(">h", bytes.fromhex(payload[98:102]))[0] / 10
-                self.to_temp(3, temp3)
-                temp4 = unpack(">h", bytes.fromhex(payload[102:106]))[0] / 10
-                self.to_temp(4, temp4)
-                self.capacity = int(payload[120:124], base=16) / 100
-                self.capacity_remaining = int(payload[124:128], base=16) / 100
-                self.history.charge_cycles = int(payload[128:132], base=16)
-                fetstatus = int(payload[148:152], base=16)
-
-                voltagestatus = int(payload[132:136], base=16)
-                currentstatus = int(payload[136:140], base=16)
-                tempstatus = int(payload[140:144], base=16)
-                warningstatus = int(payload[144:148], base=16)
-
-                # check bit 2 for TOT_OVV_PROT and bit 0 for cell_OVV_PROT
-                if voltagestatus & (1 << 2) or voltagestatus & (1 << 0):
-                    self.protection.high_voltage = 2
-                # check bit 6 for TOT_OVV_alarm and 4 for cell_OVV_alarm
-                elif voltagestatus & (1 << 6) or voltagestatus & (1 << 4):
-                    self.protection.high_voltage = 1
-                else:
-                    self.protection.high_voltage = 0
-                # NOTE: high_voltage_cell not implemented.
-                # Now incorporated in voltage_high alarm.
-                # Split if high_voltage_cell ever implemented.
-
-                # check bit 3 for TOT_UNDV_PROT
-                if voltagestatus & (1 << 3):
-                    self.protection.low_voltage = 2
-                # check bit 7 for TOT_UNDV_alarm
-                elif voltagestatus & (1 << 7):
-                    self.protection.low_voltage = 1
-                else:
-                    self.protection.low_voltage = 0
-
-                # check bit 1 for cell_UNDV_PROT
-                if voltagestatus & (1 << 1):
-                    self.protection.low_cell_voltage = 2
-                # check bit 5 for cell_UNDV_alarm
-                elif voltagestatus & (1 << 5):
-                    self.protection.low_cell_voltage = 1
-                else:
-                    self.protection.low_cell_voltage = 0
+            response = self.read_response(ser)
+            read_time = time()
 
-                # check bit 7 for low_BAT_alarm from warningstatus
-                if warningstatus & (1 << 7):
-                    self.protection.low_soc = 2
-                else:
-                    self.protection.low_soc = 0
-
-                # check bit 2 for CHG_OC_PROT
-                if currentstatus & (1 << 2):
-                    self.protection.high_charge_current = 2
-                # check bit 6 for CHG_C_alarm
-                elif currentstatus & (1 << 6):
-                    self.protection.high_charge_current = 1
-                else:
-                    self.protection.high_charge_current = 0
-
-                # check bit 4 for DISCH_OC_1_PROT, bit 5 for DISCH_OC_2_PROT and bit 3 for Short_circuit_PROT
-                if (
-                    currentstatus & (1 << 4)
-                    or currentstatus & (1 << 5)
-                    or currentstatus & (1 << 3)
-                ):
-                    self.protection.high_discharge_current = 2
-                # check bit 7 for DISCH_C_alarm
-                elif currentstatus & (1 << 7):
-                    self.protection.high_discharge_current = 1
-                else:
-                    self.protection.high_discharge_current = 0
-
-                # check bit 14 for V_DIF_PROT
-                if voltagestatus & (1 << 14):
-                    self.protection.cell_imbalance = 2
-                # check bit 8 for V_DIF_ALARM
-                elif voltagestatus & (1 << 8):
-                    self.protection.cell_imbalance = 1
-                else:
-                    self.protection.cell_imbalance = 0
-
-                # if something else is in warning, report internal failure. warningstatus
-                # contains all sorts of internal components, such as CHG_FET, NTC_fail,
-                # cell_fail, chg_mos_fail, disch_mos_fail, etc.
-                # Ignore V_DIF_alarm and low_BAT_alarm flags, since we're allready checking for those.
-                if (warningstatus & 0b01111110) > 0:
-                    self.protection.internal_failure = 2
-                else:
-                    self.protection.internal_failure = 0
-
-                # check bit 0 for CHG_H_TEMP_PROT
-                if tempstatus & (1 << 0):
-                    self.protection.high_charge_temp = 2
-                # check bit 8 for CHG_H_TEMP_alarm
-                elif tempstatus & (1 << 8):
-                    self.protection.high_charge_temp = 1
-                else:
-                    self.protection.high_charge_temp = 0
-
-                # check bit 1 for CHG_L_TEMP_PROT
-                if tempstatus & (1 << 1):
-                    self.protection.low_charge_temp = 2
-                # check bit 9 for CHG_L_TEMP_alarm
-                elif tempstatus & (1 << 9):
-                    self.protection.low_charge_temp = 1
-                else:
-                    self.protection.low_charge_temp = 0
-
-                # check bit 0 for CHG_H_TEMP_PROT and bit 2 for DISCH_H_TEMP_PROT
-                if tempstatus & (1 << 0) or tempstatus & (1 << 2):
-                    self.protection.high_temperature = 2
-                # check bit 8 for CHG_H_TEMP_alarm and bit 10 for DISCH_H_TEMP_alarm
-                elif tempstatus & (1 << 8) or tempstatus & (1 << 10):
-                    self.protection.high_temperature = 1
-                else:
-                    self.protection.high_temperature = 0
-
-                # check bit 1 for CHG_L_TEMP_PROT and bit 3 for DISCH_L_TEMP_PROT
-                if tempstatus & (1 << 1) or tempstatus & (1 << 3):
-                    self.protection.low_temperature = 2
-                # check bit 9 for CHG_L_TEMP_alarm and bit 11 for DISCH_L_TEMP_alarm
-                elif tempstatus & (1 << 9) or tempstatus & (1 << 11):
-                    self.protection.low_temperature = 1
-                else:
-                    self.protection.low_temperature = 0
-
-                # check bit 6 for MOS_H_TEMP_PROT and 4 for ENV_H_TEMP_PROT
-                if tempstatus & (1 << 6) or tempstatus & (1 << 4):
-                    self.protection.high_internal_temp = 2
-                # check bit 14 for MOS_H_TEMP_alarm and 12 for ENV_H_TEMP_alarm
-                elif tempstatus & (1 << 14) or tempstatus & (1 << 12):
-                    self.protection.high_internal_temp = 1
-                else:
-                    self.protection.high_internal_temp = 0
+            if response:
+                payload = response[13 : len(response) - 5]
+            else:
+                logger.error("get_realtime_data response error!")
+                return False
 
-                # check bit 13 for blown_fuse from voltagestatus
-                if voltagestatus & (1 << 13):
-                    self.protection.fuse_blown = 2
-                else:
-                    self.protection.fuse_blown = 0
+        result = self.parse_realtime_data(payload)
+        if result:
+            self.realtime_data_time = read_time
 
-                if fetstatus & (1 << 0):
-                    self.charge_fet = True
-                else:
-                    self.charge_fet = False
-                    self.max_battery_charge_current = 0
+        return result
 
-                if fetstatus & (1 << 1):
-                    self.discharge_fet = True
-                else:
-                    self.discharge_fet = False
-                    self.max_battery_discharge_current = 0
+    def parse_realtime_data(self, payload):
+        """
+        Extract the realtime data from the DATA Info (DATAFLAG + DATAI) of a
+        service 42 response.
+        """
+        result = False
 
-                for i in range(1, 17):
-                    cell_voltage = (
-                        int(payload[(i - 1) * 4 + 12 : i * 4 + 12], base=16) / 1000
-                    )
-                    self.cells[i - 1].voltage = cell_voltage
+        if len(payload) >= 118:
+            self.soc = int(payload[2:6], base=16) / 100
+            self.voltage = int(payload[6:10], base=16) / 100
+            self.current = unpack(">h", bytes.fromhex(payload[106:110]))[0] / 100
+            temp_mos = unpack(">h", bytes.fromhex(payload[84:88]))[0] / 10
+            self.to_temp(0, temp_mos)
+            temp1 = unpack(">h", bytes.fromhex(payload[90:94]))[0] / 10
+            self.to_temp(1, temp1)
+            temp2 = unpack(">h", bytes.fromhex(payload[94:98]))[0] / 10
+            self.to_temp(2, temp2)
+            temp3 = unpack(">h", bytes.fromhex(payload[98:102]))[0] / 10
+            self.to_temp(3, temp3)
+            temp4 = unpack(">h", bytes.fromhex(payload[102:106]))[0] / 10
+            self.to_temp(4, temp4)
+            self.capacity = int(payload[120:124], base=16) / 100
+            self.capacity_remaining = int(payload[124:128], base=16) / 100
+            self.history.charge_cycles = int(payload[128:132], base=16)
+            fetstatus = int(payload[148:152], base=16)
+
+            voltagestatus = int(payload[132:136], base=16)
+            currentstatus = int(payload[136:140], base=16)
+            tempstatus = int(payload[140:144], base=16)
+            warningstatus = int(payload[144:148], base=16)
+
+            # check bit 2 for TOT_OVV_PROT and bit 0 for cell_OVV_PROT
+            if voltagestatus & (1 << 2) or voltagestatus & (1 << 0):
+                self.protection.high_voltage = 2
+            # check bit 6 for TOT_OVV_alarm and 4 for cell_OVV_alarm
+            elif voltagestatus & (1 << 6) or voltagestatus & (1 << 4):
+                self.protection.high_voltage = 1
+            else:
+                self.protection.high_voltage = 0
+            # NOTE: high_voltage_cell not implemented.
+            # Now incorporated in voltage_high alarm.
+            # Split if high_voltage_cell ever implemented.
+
+            # check bit 3 for TOT_UNDV_PROT
+            if voltagestatus & (1 << 3):
+                self.protection.low_voltage = 2
+            # check bit 7 for TOT_UNDV_alarm
+            elif voltagestatus & (1 << 7):
+                self.protection.low_voltage = 1
+            else:
+                self.protection.low_voltage = 0
+
+            # check bit 1 for cell_UNDV_PROT
+            if voltagestatus & (1 << 1):
+                self.protection.low_cell_voltage = 2
+            # check bit 5 for cell_UNDV_alarm
+            elif voltagestatus & (1 << 5):
+                self.protection.low_cell_voltage = 1
+            else:
+                self.protection.low_cell_voltage = 0
 
-                result = True
+            # check bit 7 for low_BAT_alarm from warningstatus
+            if warningstatus & (1 << 7):
+                self.protection.low_soc = 2
+            else:
+                self.protection.low_soc = 0
+
+            # check bit 2 for CHG_OC_PROT
+            if currentstatus & (1 << 2):
+                self.protection.high_charge_current = 2
+            # check bit 6 for CHG_C_alarm
+            elif currentstatus & (1 << 6):
+                self.protection.high_charge_current = 1
+            else:
+                self.protection.high_charge_current = 0
+
+            # check bit 4 for DISCH_OC_1_PROT, bit 5 for DISCH_OC_2_PROT and bit 3 for Short_circuit_PROT
+            if (
+                currentstatus & (1 << 4)
+                or currentstatus & (1 << 5)
+                or currentstatus & (1 << 3)
+            ):
+                self.protection.high_discharge_current = 2
+            # check bit 7 for DISCH_C_alarm
+            elif currentstatus & (1 << 7):
+                self.protection.high_discharge_current = 1
+            else:
+                self.protection.high_discharge_current = 0
+
+            # check bit 14 for V_DIF_PROT
+            if voltagestatus & (1 << 14):
+                self.protection.cell_imbalance = 2
+            # check bit 8 for V_DIF_ALARM
+            elif voltagestatus & (1 << 8):
+                self.protection.cell_imbalance = 1
+            else:
+                self.protection.cell_imbalance = 0
+
+            # if something else is in warning, report internal failure. warningstatus
+            # contains all sorts of internal components, such as CHG_FET, NTC_fail,
+            # cell_fail, chg_mos_fail, disch_mos_fail, etc.
+            # Ignore V_DIF_alarm and low_BAT_alarm flags, since we're allready checking for those.
+            if (warningstatus & 0b01111110) > 0:
+                self.protection.internal_failure = 2
+            else:
+                self.protection.internal_failure = 0
+
+            # check bit 0 for CHG_H_TEMP_PROT
+            if tempstatus & (1 << 0):
+                self.protection.high_charge_temp = 2
+            # check bit 8 for CHG_H_TEMP_alarm
+            elif tempstatus & (1 << 8):
+                self.protection.high_charge_temp = 1
+            else:
+                self.protection.high_charge_temp = 0
+
+            # check bit 1 for CHG_L_TEMP_PROT
+            if tempstatus & (1 << 1):
+                self.protection.low_charge_temp = 2
+            # check bit 9 for CHG_L_TEMP_alarm
+            elif tempstatus & (1 << 9):
+                self.protection.low_charge_temp = 1
+            else:
+                self.protection.low_charge_temp = 0
+
+            # check bit 0 for CHG_H_TEMP_PROT and bit 2 for DISCH_H_TEMP_PROT
+            if tempstatus & (1 << 0) or tempstatus & (1 << 2):
+                self.protection.high_temperature = 2
+            # check bit 8 for CHG_H_TEMP_alarm and bit 10 for DISCH_H_TEMP_alarm
+            elif tempstatus & (1 << 8) or tempstatus & (1 << 10):
+                self.protection.high_temperature = 1
+            else:
+                self.protection.high_temperature = 0
+
+            # check bit 1 for CHG_L_TEMP_PROT and bit 3 for DISCH_L_TEMP_PROT
+            if tempstatus & (1 << 1) or tempstatus & (1 << 3):
+                self.protection.low_temperature = 2
+            # check bit 9 for CHG_L_TEMP_alarm and bit 11 for DISCH_L_TEMP_alarm
+            elif tempstatus & (1 << 9) or tempstatus & (1 << 11):
+                self.protection.low_temperature = 1
+            else:
+                self.protection.low_temperature = 0
+
+            # check bit 6 for MOS_H_TEMP_PROT and 4 for ENV_H_TEMP_PROT
+            if tempstatus & (1 << 6) or tempstatus & (1 << 4):
+                self.protection.high_internal_temp = 2
+            # check bit 14 for MOS_H_TEMP_alarm and 12 for ENV_H_TEMP_alarm
+            elif tempstatus & (1 << 14) or tempstatus & (1 << 12):
+                self.protection.high_internal_temp = 1
+            else:
+                self.protection.high_internal_temp = 0
+
+            # check bit 13 for blown_fuse from voltagestatus
+            if voltagestatus & (1 << 13):
+                self.protection.fuse_blown = 2
+            else:
+                self.protection.fuse_blown = 0
+
+            if fetstatus & (1 << 0):
+                self.charge_fet = True
+            else:
+                self.charge_fet = False
+                self.max_battery_charge_current = 0
+
+            if fetstatus & (1 << 1):
+                self.discharge_fet = True
             else:
-                logger.error("get_realtime_data response length error!")
+                self.discharge_fet = False
+                self.max_battery_discharge_current = 0
+
+            for i in range(1, 17):
+                cell_voltage = (
+                    int(payload[(i - 1) * 4 + 12 : i * 4 + 12], base=16) / 1000
+                )
+                self.cells[i - 1].voltage = cell_voltage
+
+            result = True
         else:
-            logger.error("get_realtime_data response error!")
+            logger.error("get_realtime_data response length error!")
 
         return result
 
+    def get_aggregated_realtime_data(self, ser):
+        """
+        Get the service 42 payload of this pack from an aggregated request to the master.
+        Every pack consumes its payload once, the next pack that finds no payload
+        of its own issues a new aggregated request for all packs.
+        The first request on a port probes if the master supports it. Without a
+        reply, aggregated polling is paused for AGGREGATED_RETRY_INTERVAL and
+        probed again. It is only disabled for good when the master answers with
+        an error or with an unknown layout.
+        The response doesn't contain the pack addresses. So it is only used when
+        the master reports exactly as many packs as there are addresses configured
+        on the port, starting at the master address. Otherwise a pack is missing
+        (or unknown) and the payloads can't be tied to their addresses safely.
+        Packs that aren't healthy don't use aggregated data, since the master may
+        still report a pack that doesn't answer itself anymore.
+        Returns the payload and the time it was read from the bus,
+        or None to fall back to per-address polling.
+        """
+        state = self.aggregated_state.setdefault(
+            self.port,
+            {
+                "supported": None,
+                "failures": 0,
+                "retry_at": 0,
+                "time": 0,
+                "payloads": {},
+                "addresses": set(),
+            },
+        )
+        if state["supported"] is False or time() < state["retry_at"]:
+            return None
+
+        if self.health != self.HEALTHY:
+            return None
+
+        # Packs configured after the last response are polled per address
+        # until the next aggregated request.
+        if state["supported"] and self.address not in state["addresses"]:
+            return None
+
+        payload = state["payloads"].pop(self.address, None)
+        if payload is not None and time() - state["time"] <= self.AGGREGATED_MAX_AGE:
+            return payload, state["time"]
+
+        blocks, supported = self.request_aggregated_realtime_data(ser)
+
+        if supported is False:
+            logger.info(
+                "Aggregated polling not supported by master, using per-address polling"
+            )
+            state["supported"] = False
+            return None
+
+        if blocks is None:
+            state["failures"] += 1
+            if (
+                state["supported"] is None
+                or state["failures"] >= self.AGGREGATED_MAX_FAILURES
+            ):
+                self.pause_aggregated_polling(state, "No reply to aggregated polling")
+            return None
+
+        addresses = sorted(self.configured_addresses.get(self.port, ()))
+        if len(blocks) != len(addresses) or addresses[0] != self.MASTER_ADDRESS:
+            self.pause_aggregated_polling(
+                state,
+                "Master reports {} packs, configured addresses: {}".format(
+                    len(blocks), ", ".join(a.hex().upper() for a in addresses)
+                ),
+            )
+            return None
+        payloads = dict(zip(addresses, blocks))
+
+        if state["supported"] is None:
+            logger.info(
+                "Aggregated polling supported by master, addresses: {}".format(
+                    ", ".join(address.hex().upper() for address in payloads)
+                )
+            )
+        state["supported"] = True
+        state["failures"] = 0
+        state["time"] = time()
+        state["payloads"] = payloads
+        state["addresses"] = set(payloads)
+
+        payload = state["payloads"].pop(self.address, None)
+        if payload is None:
+            return None
+        return payload, state["time"]
+
+    def pause_aggregated_polling(self, state, reason):
+        """
+        Use per-address polling until the next probe after AGGREGATED_RETRY_INTERVAL.
+        """
+        logger.warning(
+            "{}, using per-address polling and probing again in {}s".format(
+                reason, self.AGGREGATED_RETRY_INTERVAL
+            )
+        )
+        state["supported"] = None
+        state["failures"] = 0
+        state["payloads"] = {}
+        state["retry_at"] = time() + self.AGGREGATED_RETRY_INTERVAL
+
+    def request_aggregated_realtime_data(self, ser):
+        """
+        Read realtime data of all packs from the master by calling service 42
+        with command info FF ('all packs' in the 1363 framework).
+        Returns the payloads in response order and whether the master supports it:
+        (payloads, True) for a valid response, (None, False) when the master
+        answers with an error or an unknown layout, (None, None) without a valid reply.
+        """
+        req = self.create_command_get_realtime_data_all()
+
+        ser.flushOutput()
+        ser.flushInput()
+        ser.write(req.encode())
+        logger.debug("get_realtime_data_all request sent: {}".format(req))
+
+        sleep(0.5)  # Allow the BMS some time to send a full response
+        # The response grows with the number of packs, wait until the bus is quiet,
+        # but not forever: other traffic on the bus may keep it busy.
+        deadline = time() + self.AGGREGATED_MAX_WAIT
+        waiting = ser.inWaiting()
+        while time() < deadline:
+            sleep(0.1)
+            if ser.inWaiting() == waiting:
+                break
+            waiting = ser.inWaiting()
+
+        response = self.read_response(ser)
+
+        if response:
+            payloads = self.split_aggregated_realtime_data(
+                response[13 : len(response) - 5]
+            )
+            if payloads is None:
+                logger.debug("get_realtime_data_all response format error!")
+                return None, False
+            return payloads, True
+        elif self.response_rtn not in (None, "00"):
+            logger.debug(
+                "get_realtime_data_all rejected, RTN: {}".format(self.response_rtn)
+            )
+            return None, False
+        else:
+            logger.debug("get_realtime_data_all response error!")
+
+        return None, None
+
+    def split_aggregated_realtime_data(self, payload):
+        """
+        Split the DATA Info of an aggregated service 42 response into a list of
+        payloads (DATAFLAG + DATAI), as returned by a per-address request.
+        Expected layout: DATAFLAG, pack count, followed by the DATAI of every pack,
+        in address order. The DATAI doesn't contain the address of the pack.
+        The length of each DATAI depends on its cell count (m) and temperature count (n).
+        Returns None if the payload doesn't match this layout exactly.
+        """
+        payloads = []
+        dataflag = payload[0:2]
+        try:
+            count = int(payload[2:4], base=16)
+            offset = 4
+            for _ in range(count):
+                num_of_cells = int(payload[offset + 8 : offset + 10], base=16)
+                temps = offset + 10 + num_of_cells * 4 + 12
+                num_of_temps = int(payload[temps : temps + 2], base=16)
+                # SOC, voltage, m, cells, 3 temps, n, temps, 46 bytes up to IO status
+                length = 4 + 4 + 2 + num_of_cells * 4 + 12 + 2 + num_of_temps * 4 + 92
+                if offset + length > len(payload):
+                    return None
+                payloads.append(dataflag + payload[offset : offset + length])
+                offset += length
+        except ValueError:
+            return None
+
+        if count == 0 or offset != len(payload):
+            return None
+
+        return payloads
+
     def get_manufacturer_info(self, ser):
         """
         Read manufacturer info from device by calling the get_manufacturer_info command,
@@ -539,6 +910,11 @@ class Daren485(Battery):
                 logger.error("Exception during inWaiting(): {}".format(e))
                 pass
 
+        # RTN of the response, None if no response header was received
+        self.response_rtn = (
+            buff[7:9] if buff.startswith("~") and len(buff) >= 9 else None
+        )
+
         try:
             CID2 = buff[7:9]
             if self.CID2_decode(CID2) == -1:
@@ -635,6 +1011,14 @@ class Daren485(Battery):
             self.address, b"\x4A", b"\x42", self.address.hex().upper()
         )
 
+    def create_command_get_realtime_data_all(self):
+        """
+        Generates command that utilizes Service 42 of the master BMS for all packs.
+        Example command (mark the \r at the end):
+        ~22014A42E002FFFCFD␍
+        """
+        return self.create_command(self.MASTER_ADDRESS, b"\x4A", b"\x42", "FF")
+
     def create_command_get_manufacturer_info(self):
         """
         Generates command that utilizes Service 51 of the BMS.
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Shared-memory state export for the Daren485 driver.
+# The driver publishes the latest decoded state of each pack to a small
+# memory-mapped file under /dev/shm, one file per pack (port + address).
+# Other local tools (e.g. a load switcher like the DR-JC03-RS485-Switcher)
+# can read SOC, cell voltages and alarms from there, without opening the
+# RS485 bus themselves.
+#
+# This module only uses the python standard library, so it can be copied
+# next to any tool that wants to read the state:
+#
+#   from daren_485_shm import StateReader, list_states
+#   for path in list_states():
+#       with StateReader(path) as reader:
+#           print(reader.read())
+#
+# Or run it directly to dump all published states:
+#   python3 daren_485_shm.py
+
+from math import isnan, nan
+from struct import Struct
+from time import sleep, time
+from zlib import crc32
+import glob
+import mmap
+import os
+import sys
+
+SHM_DIR = "/dev/shm"
+SHM_PREFIX = "daren485_"
+
+MAGIC = b"DR485SHM"
+# Bump LAYOUT_VERSION on every change of the header or payload layout,
+# readers refuse regions with a different version.
+LAYOUT_VERSION = 2
+
+MAX_CELLS = 32
+MAX_TEMPS = 5  # temp_mos, temp1..temp4
+
+# protection values as used by dbus-serialbattery: 0 = ok, 1 = alarm, 2 = protection
+PROTECTION_FIELDS = (
+    "high_voltage",
+    "low_voltage",
+    "low_cell_voltage",
+    "low_soc",
+    "high_charge_current",
+    "high_discharge_current",
+    "cell_imbalance",
+    "internal_failure",
+    "high_charge_temp",
+    "low_charge_temp",
+    "high_temperature",
+    "low_temperature",
+    "high_internal_temp",
+    "fuse_blown",
+)
+PROTECTION_UNKNOWN = 0xFF
+
+# header: magic, layout version, header size, payload size, sequence counter,
+# CRC32 of the payload
+HEADER = Struct("<8sHHIQI")
+SEQ_OFFSET = 16
+SEQ = Struct("<Q")
+CRC_OFFSET = 24
+CRC = Struct("<I")
+
+# payload: timestamp, address, cell count, temp count, fet flags, serial number,
+# soc, voltage, current, capacity, capacity remaining, charge cycles,
+# temperatures, cell voltages, protection values
+PAYLOAD = Struct(
+    "<dBBBB16s5dI{}d{}d{}B".format(MAX_TEMPS, MAX_CELLS, len(PROTECTION_FIELDS))
+)
+
+REGION_SIZE = HEADER.size + PAYLOAD.size
+
+FLAG_CHARGE_FET = 1 << 0
+FLAG_DISCHARGE_FET = 1 << 1
+
+READ_RETRIES = 100
+READ_BACKOFF = 0.00001  # seconds, wait for the writer to finish an update
+
+
+def state_path(port, address):
+    """
+    Returns the shared-memory path of a pack, based on the serial port
+    (e.g. /dev/ttyUSB0) and the pack address (e.g. b"\\x01").
+    """
+    return os.path.join(
+        SHM_DIR,
+        "{}{}_{}".format(SHM_PREFIX, os.path.basename(port), address.hex().upper()),
+    )
+
+
+def list_states():
+    """
+    Returns the paths of all published pack states, sorted by name.
+    """
+    return sorted(glob.glob(os.path.join(SHM_DIR, SHM_PREFIX + "*")))
+
+
+def _float(value):
+    return nan if value is None else float(value)
+
+
+def _value(value):
+    return None if isnan(value) else value
+
+
+class StateWriter:
+    """
+    Publishes the state of one pack to its shared-memory region.
+    Uses a seqlock: the sequence counter is odd while the payload is being
+    written and even once it is complete, so readers never need to lock.
+    Python can't fence the stores to the mapping, so on weakly ordered CPUs
+    (e.g. the ARM based GX devices) readers also check the CRC32 of the payload.
+    Only one writer per region is supported.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != REGION_SIZE:
+                os.ftruncate(fd, REGION_SIZE)
+            self.mm = mmap.mmap(fd, REGION_SIZE)
+        finally:
+            os.close(fd)
+
+        magic, version, header_size, payload_size, seq, crc = HEADER.unpack_from(
+            self.mm
+        )
+        if (
+            magic != MAGIC
+            or version != LAYOUT_VERSION
+            or header_size != HEADER.size
+            or payload_size != PAYLOAD.size
+            or seq & 1
+        ):
+            # a previous writer died while writing (odd sequence), or the layout
+            # changed: the payload can't be trusted, report nothing published.
+            seq = 0
+            crc = 0
+        self.seq = seq
+        HEADER.pack_into(
+            self.mm,
+            0,
+            MAGIC,
+            LAYOUT_VERSION,
+            HEADER.size,
+            PAYLOAD.size,
+            self.seq,
+            crc,
+        )
+
+    def publish(self, battery, timestamp=None):
+        """
+        Writes the current state of a Battery object to the region.
+        timestamp is the time the data was read from the bus, defaults to now.
+        """
+        cells = [_float(cell.voltage) for cell in battery.cells[:MAX_CELLS]]
+        cell_count = len(cells)
+        cells += [nan] * (MAX_CELLS - cell_count)
+
+        temps = [
+            _float(battery.temp_mos),
+            _float(battery.temp1),
+            _float(battery.temp2),
+            _float(battery.temp3),
+            _float(battery.temp4),
+        ]
+
+        protection = []
+        for field in PROTECTION_FIELDS:
+            value = getattr(battery.protection, field, None)
+            protection.append(PROTECTION_UNKNOWN if value is None else int(value))
+
+        flags = 0
+        if battery.charge_fet:
+            flags |= FLAG_CHARGE_FET
+        if battery.discharge_fet:
+            flags |= FLAG_DISCHARGE_FET
+
+        payload = PAYLOAD.pack(
+            time() if timestamp is None else timestamp,
+            battery.address[0],
+            cell_count,
+            MAX_TEMPS,
+            flags,
+            battery.serial_number.encode(errors="replace")[:16],
+            _float(battery.soc),
+            _float(battery.voltage),
+            _float(battery.current),
+            _float(battery.capacity),
+            _float(battery.capacity_remaining),
+            int(battery.history.charge_cycles or 0),
+            *temps,
+            *cells,
+            *protection,
+        )
+
+        self.seq += 1
+        SEQ.pack_into(self.mm, SEQ_OFFSET, self.seq)
+        self.mm[HEADER.size : REGION_SIZE] = payload
+        CRC.pack_into(self.mm, CRC_OFFSET, crc32(payload))
+        self.seq += 1
+        SEQ.pack_into(self.mm, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.mm.close()
+
+
+class StateReader:
+    """
+    Reads the state of one pack from its shared-memory region.
+    Raises ValueError if the region has been created with a different layout.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), REGION_SIZE, access=mmap.ACCESS_READ)
+
+        magic, version, header_size, payload_size, _, _ = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError("{} is not a Daren485 state region".format(path))
+        if (
+            version != LAYOUT_VERSION
+            or header_size != HEADER.size
+            or payload_size != PAYLOAD.size
+        ):
+            self.mm.close()
+            raise ValueError(
+                "{} has layout version {}, expected {}".format(
+                    path, version, LAYOUT_VERSION
+                )
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_raw(self):
+        """
+        Returns a consistent copy of the payload bytes, or None if nothing has
+        been published yet or no consistent copy could be taken.
+        """
+        for _ in range(READ_RETRIES):
+            seq1 = SEQ.unpack_from(self.mm, SEQ_OFFSET)[0]
+            if seq1 == 0:
+                return None
+            if seq1 & 1:
+                sleep(READ_BACKOFF)  # writer busy, let it finish
+                continue
+            crc = CRC.unpack_from(self.mm, CRC_OFFSET)[0]
+            payload = self.mm[HEADER.size : REGION_SIZE]
+            seq2 = SEQ.unpack_from(self.mm, SEQ_OFFSET)[0]
+            if seq1 == seq2 and crc32(payload) == crc:
+                return payload
+            sleep(READ_BACKOFF)
+        return None
+
+    def read(self):
+        """
+        Returns the latest published state as a dict, or None if not available.
+        Values the driver did not (yet) decode are returned as None.
+        """
+        payload = self.read_raw()
+        if payload is None:
+            return None
+
+        values = PAYLOAD.unpack(payload)
+        timestamp, address, cell_count, temp_count, flags, serial_number = values[0:6]
+        soc, voltage, current, capacity, capacity_remaining = values[6:11]
+        charge_cycles = values[11]
+        offset = 12
+        temps = values[offset : offset + MAX_TEMPS]
+        offset += MAX_TEMPS
+        cells = values[offset : offset + MAX_CELLS]
+        offset += MAX_CELLS
+        protection = values[offset : offset + len(PROTECTION_FIELDS)]
+
+        return {
+            "timestamp": timestamp,
+            "age": time() - timestamp,
+            "address": address,
+            "serial_number": serial_number.rstrip(b"\0").decode(errors="replace"),
+            "soc": _value(soc),
+            "voltage": _value(voltage),
+            "current": _value(current),
+            "capacity": _value(capacity),
+            "capacity_remaining": _value(capacity_remaining),
+            "charge_cycles": charge_cycles,
+            "charge_fet": bool(flags & FLAG_CHARGE_FET),
+            "discharge_fet": bool(flags & FLAG_DISCHARGE_FET),
+            "temp_mos": _value(temps[0]),
+            "temps": [_value(t) for t in temps[1:temp_count]],
+            "cells": [_value(v) for v in cells[:cell_count]],
+            "protection": {
+                field: (None if value == PROTECTION_UNKNOWN else value)
+                for field, value in zip(PROTECTION_FIELDS, protection)
+            },
+        }
+
+    def close(self):
+        self.mm.close()
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or list_states()
+    if not paths:
+        print("No Daren485 states found in {}".format(SHM_DIR))
+    for path in paths:
+        with StateReader(path) as reader:
+            print("{}: {}".format(path, reader.read()))